@@ -1,12 +1,27 @@
 """ Dataset class. """
 import abc
+import functools
+import hashlib
 import importlib
-import inspect
+import itertools
+import multiprocessing
 import os
 import pickle
 from collections import defaultdict
 from pathlib import Path
-from typing import Tuple, Set, List, Optional, TypeVar, Type, Dict
+from typing import (
+    Tuple,
+    Set,
+    List,
+    Optional,
+    TypeVar,
+    Type,
+    Dict,
+    Iterable,
+    Iterator,
+    FrozenSet,
+    Callable,
+)
 
 import numpy
 import spacy
@@ -15,25 +30,67 @@ import yaml
 from spacy import Language
 from spacy.kb import KnowledgeBase
 from spacy.tokens import Doc, DocBin
-from spacy.training import Example
+from spacy.vocab import Vocab
 from schemas import Annotation, Entity
 from . import evaluation
 from utils import get_logger
 
 logger = get_logger(__name__)
+_ROOT_PATH = Path(os.path.abspath(__file__)).parent.parent.parent
 DatasetType = TypeVar("DatasetType", bound="Dataset")
+# Reference entities as (start_char, end_char, kb_id_, text).
+ReferenceEntitiesType = Tuple[Tuple[int, int, str, str], ...]
+
+
+@functools.lru_cache(maxsize=1)
+def _load_yaml(path: Path) -> Dict:
+    """Loads and caches YAML file. Uses libyaml-based loader if available.
+    path (Path): Path to YAML file.
+    RETURNS (Dict): Parsed YAML content.
+    """
+
+    with open(path, "r") as stream:
+        return yaml.load(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+@functools.lru_cache(maxsize=None)
+def _assemble_paths(dataset_name: str) -> Tuple[Tuple[str, Path], ...]:
+    """Assembles and caches paths w.r.t. dataset ID. Paths are returned as immutable pairs, so that the cached value
+    can't be modified by callers.
+    dataset_name (str): Dataset name.
+    RETURNS (Tuple[Tuple[str, Path], ...]): Pairs of internal resource name and path.
+    """
+
+    root_path = _ROOT_PATH
+    assets_path = root_path / "assets" / dataset_name
+
+    return (
+        ("root", root_path),
+        ("assets", assets_path),
+        ("nlp_base", root_path / "temp" / dataset_name / "nlp"),
+        ("nlp_best", root_path / "training" / dataset_name / "model-best"),
+        ("kb", root_path / "temp" / dataset_name / "kb"),
+        ("corpora", root_path / "corpora" / dataset_name),
+        ("entities", assets_path / "entities.pkl"),
+        ("failed_entity_lookups", assets_path / "entities_failed_lookups.pkl"),
+        ("annotations", assets_path / "annotations.pkl"),
+    )
 
 
 class Dataset(abc.ABC):
     """Base class for all datasets used in this benchmark."""
 
+    _registry: Dict[str, Type["Dataset"]] = {}
+
     def __init__(self):
         """Initializes new Dataset."""
 
         self._paths = self.assemble_paths(self.name)
 
-        with open(self._paths["root"] / "configs" / "datasets.yml", "r") as stream:
-            self._options = yaml.safe_load(stream)[self.name]
+        # Copied, as the parsed YAML content is cached and shared across instances.
+        self._options = dict(
+            _load_yaml(self._paths["root"] / "configs" / "datasets.yml")[self.name]
+        )
 
         self._entities: Optional[Dict[str, Entity]] = None
         self._failed_entity_lookups: Optional[Set[str]] = None
@@ -43,27 +100,29 @@ class Dataset(abc.ABC):
         self._nlp_best: Optional[Language] = None
         self._annotated_docs: Optional[List[Doc]] = None
 
+    @classmethod
+    def register(
+        cls, dataset_name: str
+    ) -> Callable[[Type[DatasetType]], Type[DatasetType]]:
+        """Returns decorator registering a Dataset class under the specified dataset name.
+        dataset_name (str): Dataset name.
+        RETURNS (Callable[[Type[DatasetType]], Type[DatasetType]]): Decorator registering the decorated Dataset class.
+        """
+
+        def register_dataset(dataset_class: Type[DatasetType]) -> Type[DatasetType]:
+            cls._registry[dataset_name] = dataset_class
+            return dataset_class
+
+        return register_dataset
+
     @staticmethod
     def assemble_paths(dataset_name: str) -> Dict[str, Path]:
-        """Assemble paths w.r.t. dataset ID.
+        """Assemble paths w.r.t. dataset ID. Paths are cached per dataset name, each call returns a new dictionary.
         dataset_name (str): Dataset name.
         RETURNS (Dict[str, Path]): Dictionary with internal resource name to path.
         """
 
-        root_path = Path(os.path.abspath(__file__)).parent.parent.parent
-        assets_path = root_path / "assets" / dataset_name
-
-        return {
-            "root": root_path,
-            "assets": assets_path,
-            "nlp_base": root_path / "temp" / dataset_name / "nlp",
-            "nlp_best": root_path / "training" / dataset_name / "model-best",
-            "kb": root_path / "temp" / dataset_name / "kb",
-            "corpora": root_path / "corpora" / dataset_name,
-            "entities": assets_path / "entities.pkl",
-            "failed_entity_lookups": assets_path / "entities_failed_lookups.pkl",
-            "annotations": assets_path / "annotations.pkl",
-        }
+        return dict(_assemble_paths(dataset_name))
 
     @property
     def name(self) -> str:
@@ -90,21 +149,39 @@ class Dataset(abc.ABC):
             vocab=self._nlp_base.vocab,
             entity_vector_length=self._nlp_base.vocab.vectors_length,
         )
-        entity_list: List[str] = []
-        count_list: List[int] = []
-        vector_list: List[numpy.ndarray] = []
-        for qid, info in self._entities.items():
-            entity_list.append(qid)
-            count_list.append(info.count)
-            vector_list.append(self._nlp_base(info.description).vector)
-        self._kb.set_entities(
-            entity_list=entity_list, vector_list=vector_list, freq_list=count_list
+        # Entity columns and alias groups are collected in a single pass over all entities. Entities are grouped by
+        # alias, as the KB only accepts one add_alias() call per alias. Prior probabilities are proportional to the
+        # entities' counts, and uniform if none of an alias' entities has been counted.
+        qids: List[str] = []
+        counts: List[int] = []
+        descriptions: List[str] = []
+        missing_descriptions: List[str] = []
+        alias_entities: Dict[str, Dict[str, int]] = defaultdict(dict)
+        for qid, entity in self._entities.items():
+            if entity.description is None:
+                missing_descriptions.append(qid)
+            qids.append(qid)
+            counts.append(entity.count)
+            descriptions.append(entity.description)
+            for name in entity.aliases:
+                alias_entities[name.replace("_", " ")][qid] = entity.count
+        assert not missing_descriptions, (
+            f"{len(missing_descriptions)} entities without description can't be embedded, e.g. "
+            f"{missing_descriptions[:5]}."
         )
-        for qid, info in self._entities.items():
-            for name in info.aliases:
-                self._kb.add_alias(
-                    alias=name.replace("_", " "), entities=[qid], probabilities=[1]
-                )
+
+        vectors = self._load_description_vectors(model_name, descriptions)
+        self._kb.set_entities(entity_list=qids, vector_list=vectors, freq_list=counts)
+        for alias, entity_counts in alias_entities.items():
+            total_count = sum(entity_counts.values())
+            self._kb.add_alias(
+                alias=alias,
+                entities=list(entity_counts.keys()),
+                probabilities=[
+                    count / total_count if total_count else 1 / len(entity_counts)
+                    for count in entity_counts.values()
+                ],
+            )
 
         # Serialize knowledge base & entity information.
         for to_serialize in (
@@ -113,13 +190,83 @@ class Dataset(abc.ABC):
             (self._paths["annotations"], self._annotations),
         ):
             with open(to_serialize[0], "wb") as fp:
-                pickle.dump(to_serialize[1], fp)
+                pickle.dump(to_serialize[1], fp, protocol=pickle.HIGHEST_PROTOCOL)
         self._kb.to_disk(self._paths["kb"])
-        if not os.path.exists(self._paths["nlp_base"]):
-            os.mkdir(self._paths["nlp_base"])
+        self._paths["nlp_base"].mkdir(parents=True, exist_ok=True)
         self._nlp_base.to_disk(self._paths["nlp_base"])
         logger.info("Successfully constructed knowledge base.")
 
+    def _load_description_vectors(
+        self, model_name: str, descriptions: List[str]
+    ) -> numpy.ndarray:
+        """Loads description vectors from the on-disk cache. Computes and caches them first if they are not available
+        for this combination of model and descriptions yet.
+        model_name (str): Name of model with word vectors to use.
+        descriptions (List[str]): Entity descriptions.
+        RETURNS (numpy.ndarray): Description vectors with shape (len(descriptions), vectors_length).
+        """
+
+        if not descriptions:
+            return self._embed_descriptions(descriptions)
+
+        # Model name alone doesn't identify the vectors, as a model upgrade may ship different vectors under the same
+        # name.
+        shape = (len(descriptions), self._nlp_base.vocab.vectors_length)
+        digest = hashlib.blake2b()
+        for key_part in (
+            model_name,
+            self._nlp_base.meta.get("version", ""),
+            self._nlp_base.vocab.vectors.name or "",
+            str(shape[1]),
+            *descriptions,
+        ):
+            digest.update(key_part.encode("utf-8") + b"\0")
+        path = self._paths["assets"] / f"entity_vectors_{digest.hexdigest()}.mmap"
+
+        if not path.exists():
+            # Remove stale caches computed for other models or descriptions, incl. temporary files left behind by
+            # interrupted runs.
+            for stale_path in self._paths["assets"].glob("entity_vectors_*"):
+                stale_path.unlink()
+            logger.info("Computing description vectors")
+            # Write to temporary file first, so that an interrupted run doesn't leave an incomplete cache behind.
+            tmp_path = path.with_suffix(".tmp")
+            vectors = numpy.memmap(
+                tmp_path, mode="w+", dtype=numpy.float32, shape=shape
+            )
+            vectors[:] = self._embed_descriptions(descriptions)
+            vectors.flush()
+            del vectors
+            tmp_path.replace(path)
+
+        return numpy.memmap(path, mode="r", dtype=numpy.float32, shape=shape)
+
+    def _embed_descriptions(self, descriptions: List[str]) -> numpy.ndarray:
+        """Computes description vectors as the mean of their tokens' word vectors. This is equivalent to Doc.vector,
+        but only requires tokenization and a lookup in the vectors table instead of running the whole pipeline. Falls
+        back to Doc.vector on the tokenized descriptions for floret vectors.
+        descriptions (List[str]): Entity descriptions.
+        RETURNS (numpy.ndarray): Description vectors with shape (len(descriptions), vectors_length).
+        """
+
+        vectors_table = self._nlp_base.vocab.vectors
+        vectors = numpy.zeros(
+            (len(descriptions), self._nlp_base.vocab.vectors_length),
+            dtype=numpy.float32,
+        )
+        for i, doc in enumerate(
+            self._nlp_base.tokenizer.pipe(descriptions, batch_size=256)
+        ):
+            # Vectors.find() isn't supported for floret vectors, which compute vectors from subword hashes instead.
+            if vectors_table.mode != "default":
+                vectors[i] = doc.vector
+            elif len(doc):
+                rows = vectors_table.find(keys=doc.to_array("ORTH"))
+                # Tokens without vectors count as zero vectors, as they do in Doc.vector.
+                vectors[i] = vectors_table.data[rows[rows >= 0]].sum(axis=0) / len(doc)
+
+        return vectors
+
     def compile_corpora(self) -> None:
         """Creates train/dev/test corpora for Reddit entity linking dataset."""
 
@@ -138,6 +285,25 @@ class Dataset(abc.ABC):
         """
         raise NotImplementedError
 
+    def _nlp_pipe(
+        self,
+        texts: Iterable[str],
+        batch_size: int = 128,
+        n_process: Optional[int] = None,
+    ) -> Iterator[Doc]:
+        """Processes texts with base pipeline in batches, distributed over multiple processes.
+        texts (Iterable[str]): Texts to process.
+        batch_size (int): Number of texts to buffer.
+        n_process (Optional[int]): Number of processes to use. If None, all but one of the available CPUs are used.
+        RETURNS (Iterator[Doc]): Processed docs in the same order as texts.
+        """
+
+        return self._nlp_base.pipe(
+            texts,
+            batch_size=batch_size,
+            n_process=n_process or max(1, (os.cpu_count() or 1) - 1),
+        )
+
     def _parse_external_corpus(
         self, **kwargs
     ) -> Tuple[Dict[str, Entity], Set[str], Dict[str, List[Annotation]]]:
@@ -158,29 +324,20 @@ class Dataset(abc.ABC):
             == 1
         )
 
-        indices = {
-            dataset: idx
-            for dataset, idx in zip(
-                ("train", "dev", "test"),
-                numpy.split(
-                    numpy.asarray(range(len(self._annotated_docs))),
-                    [
-                        int(self._options["frac_train"] * len(self._annotated_docs)),
-                        int(
-                            (self._options["frac_train"] + self._options["frac_dev"])
-                            * len(self._annotated_docs)
-                        ),
-                    ],
-                ),
-            )
+        n_docs = len(self._annotated_docs)
+        dev_start = int(self._options["frac_train"] * n_docs)
+        test_start = int(
+            (self._options["frac_train"] + self._options["frac_dev"]) * n_docs
+        )
+        splits = {
+            "train": self._annotated_docs[:dev_start],
+            "dev": self._annotated_docs[dev_start:test_start],
+            "test": self._annotated_docs[test_start:],
         }
 
-        for key, value in indices.items():
-            corpus = DocBin(store_user_data=True)
-            for idx in value:
-                corpus.add(self._annotated_docs[idx])
-            if not self._paths["corpora"].exists():
-                self._paths["corpora"].mkdir()
+        self._paths["corpora"].mkdir(parents=True, exist_ok=True)
+        for key, docs in splits.items():
+            corpus = DocBin(docs=docs, store_user_data=True)
             corpus.to_disk(self._paths["corpora"] / f"{key}.spacy")
         logger.info(f"Completed serializing corpora at {self._paths['corpora']}.")
 
@@ -197,11 +354,10 @@ class Dataset(abc.ABC):
         elif key == "nlp_best" and (force or not self._nlp_best):
             self._nlp_best = spacy.load(path)
         elif key == "kb" and (force or not self._kb):
-            self._load_resource("nlp_base")
-            self._kb = KnowledgeBase(
-                vocab=self._nlp_base.vocab,
-                entity_vector_length=self._nlp_base.vocab.vectors_length,
-            )
+            # The KB only needs the vocab's strings, so the full base pipeline isn't loaded unless it's already
+            # available. The entity vector length is restored from the serialized KB.
+            vocab = self._nlp_base.vocab if self._nlp_base else self._load_vocab_only()
+            self._kb = KnowledgeBase(vocab=vocab, entity_vector_length=0)
             self._kb.from_disk(path)
         elif key == "annotations" and (force or not self._annotations):
             with open(path, "rb") as file:
@@ -212,34 +368,76 @@ class Dataset(abc.ABC):
         elif key == "failed_entity_lookups" and (
             force or not self._failed_entity_lookups
         ):
-            with open(self._paths["failed_entity_lookups"], "rb") as file:
+            with open(path, "rb") as file:
                 self._failed_entity_lookups = pickle.load(file)
 
+    def _load_vocab_only(self) -> Vocab:
+        """Loads vocab of base pipeline without loading its components or word vectors.
+        RETURNS (Vocab): Vocab of base pipeline without vectors.
+        """
+
+        return Vocab().from_disk(
+            self._paths["nlp_base"] / "vocab", exclude=["vectors"]
+        )
+
     def evaluate(
         self,
         candidate_generation: bool = True,
         baseline: bool = True,
         context: bool = True,
         n_items: Optional[int] = None,
+        n_process: int = 1,
     ) -> None:
         """Evaluates trained pipeline on test set.
         baseline (bool): Whether to include baseline results in evaluation.
         context (bool): Whether to include the local context in the model.
         n_items (Optional[int]): How many items to consider in evaluation. If None, all items in test set are used.
+        n_process (int): Number of processes to use for processing the test set. Values > 1 require the "fork" start
+            method.
         """
 
+        assert n_process == 1 or multiprocessing.get_start_method() == "fork", (
+            "Multi-process evaluation requires the 'fork' start method, as the pipeline's KB can't be pickled for "
+            "spawned processes."
+        )
+
         # Load resources.
         self._load_resource("nlp_best")
         self._load_resource("kb")
-        test_set_path = self._paths["corpora"] / "test.spacy"
-        with open(test_set_path, "rb"):
-            test_set = [
-                Example(self._nlp_best(doc.text), doc)
-                for doc in DocBin()
-                .from_disk(test_set_path)
-                .get_docs(self._nlp_best.vocab)
-            ]
-        self._nlp_best.config["incl_prior"] = False
+        test_set = DocBin().from_disk(self._paths["corpora"] / "test.spacy")
+        # DocBin knows its number of docs without deserializing them, so the progress bar can show the correct total.
+        n_docs = len(test_set) if n_items is None else min(n_items, len(test_set))
+
+        def iter_test_set() -> Iterator[Tuple[Doc, ReferenceEntitiesType]]:
+            """Lazily yields predicted docs with their reference entities, so that only docs currently being processed
+            are kept in memory. Reference entities are reduced to plain tuples, so reference docs can be discarded
+            right away.
+            RETURNS (Iterator[Tuple[Doc, ReferenceEntitiesType]]): Predicted docs and reference entities.
+            """
+            ref_docs = itertools.islice(test_set.get_docs(self._nlp_best.vocab), n_docs)
+            # Shared by the pipe generator and zip(), so that iterating over the pipeline's output doesn't exhaust
+            # the reference docs.
+            ref_docs, texts = itertools.tee(ref_docs)
+            # The entity linker is applied separately for each disambiguation setting further below, so it can be
+            # skipped here.
+            pred_docs = self._nlp_best.pipe(
+                (doc.text for doc in texts),
+                batch_size=64,
+                n_process=n_process,
+                disable=["entity_linker"],
+            )
+            for pred_doc, ref_doc in zip(pred_docs, ref_docs):
+                yield pred_doc, tuple(
+                    (ent.start_char, ent.end_char, ent.kb_id_, ent.text)
+                    for ent in ref_doc.ents
+                )
+
+        # Mention strings repeat frequently, so candidate lookups are cached for the duration of the evaluation.
+        @functools.lru_cache(maxsize=None)
+        def get_candidate_ids(alias: str) -> FrozenSet[str]:
+            return frozenset(
+                cand.entity_ for cand in self._kb.get_alias_candidates(alias)
+            )
 
         # Evaluation loop.
         label_counts = dict()
@@ -248,33 +446,40 @@ class Dataset(abc.ABC):
         context_results = evaluation.EvaluationResults("Context only")
         combo_results = evaluation.EvaluationResults("Context and Prior")
         candidate_results = evaluation.EvaluationResults("Candidate gen.")
-
-        for example in tqdm.tqdm(
-            test_set, total=n_items, leave=False, desc="Processing test set"
-        ):
-            if len(example) > 0:
+        # The linker reads incl_context/incl_prior from its own attributes, not from the pipeline config, so switching
+        # between disambiguation settings is cheap and can be done per doc instead of keeping all predicted docs for
+        # separate passes. Its original settings are restored afterwards.
+        entity_linker = self._nlp_best.get_pipe("entity_linker")
+        incl_context, incl_prior = entity_linker.incl_context, entity_linker.incl_prior
+
+        try:
+            for pred_doc, ref_ents in tqdm.tqdm(
+                iter_test_set(),
+                total=n_docs,
+                leave=True,
+                mininterval=0.5,
+                desc="Processing test set",
+            ):
+                # Docs without reference entities don't contribute to any metric, so they are skipped right away.
+                if len(pred_doc) == 0 or not ref_ents:
+                    continue
                 correct_ents = {
-                    evaluation.offset(ent.start_char, ent.end_char): ent.kb_id_
-                    for ent in example.reference.ents
-                }
-                ent_labels = {
-                    (ent.start_char, ent.end_char): ent.label_
-                    for ent in example.predicted.ents
+                    evaluation.offset(start, end): kb_id
+                    for start, end, kb_id, _ in ref_ents
                 }
 
                 # Update candidate generation stats.
                 if candidate_generation:
-                    for ent in example.reference.ents:
+                    ent_labels = {
+                        (ent.start_char, ent.end_char): ent.label_
+                        for ent in pred_doc.ents
+                    }
+                    for start, end, kb_id, text in ref_ents:
                         # For the candidate generation evaluation also mis-aligned entities are considered.
-                        label = ent_labels.get((ent.start_char, ent.end_char), "NIL")
+                        label = ent_labels.get((start, end), "NIL")
                         cand_gen_label_counts[label] += 1
                         candidate_results.update_metrics(
-                            label,
-                            ent.kb_id_,
-                            {
-                                cand.entity_
-                                for cand in self._kb.get_alias_candidates(ent.text)
-                            },
+                            label, kb_id, get_candidate_ids(text)
                         )
 
                 # Update entity disambiguation stats.
@@ -282,25 +487,27 @@ class Dataset(abc.ABC):
                     evaluation.add_disambiguation_baseline(
                         baseline_results,
                         label_counts,
-                        example.predicted,
+                        pred_doc,
                         correct_ents,
                         self._kb,
                     )
 
+                # Predicted docs already carry sentences and entities, so only the entity linker component has to be
+                # applied, once per disambiguation setting.
                 if context:
-                    # Using only context.
-                    self._nlp_best.config["incl_context"] = True
-                    self._nlp_best.config["incl_prior"] = False
+                    entity_linker.incl_context = True
+                    entity_linker.incl_prior = False
                     evaluation.add_disambiguation_eval_result(
-                        context_results, example.predicted, correct_ents, self._nlp_best
+                        context_results, pred_doc, correct_ents, entity_linker
                     )
-
-                    # measuring combined accuracy (prior + context)
-                    self._nlp_best.config["incl_context"] = True
-                    self._nlp_best.config["incl_prior"] = True
+                    entity_linker.incl_prior = True
                     evaluation.add_disambiguation_eval_result(
-                        combo_results, example.predicted, correct_ents, self._nlp_best
+                        combo_results, pred_doc, correct_ents, entity_linker
                     )
+        finally:
+            entity_linker.incl_context = incl_context
+            entity_linker.incl_prior = incl_prior
+            get_candidate_ids.cache_clear()
 
         # Print result table.
         eval_results: List[evaluation.EvaluationResults] = []
@@ -319,9 +526,6 @@ class Dataset(abc.ABC):
         logger.info(dict(cand_gen_label_counts))
         evaluation.EvaluationResults.report(tuple(eval_results))
 
-        self._nlp_best.config["incl_context"] = False
-        self._nlp_best.config["incl_prior"] = False
-
     @classmethod
     def generate_dataset_from_id(
         cls: Type[DatasetType], dataset_name: str, **kwargs
@@ -331,20 +535,15 @@ class Dataset(abc.ABC):
         RETURNS (DatasetType): Instance of dataset with type determined by dataset ID.
         """
 
-        # Assuming dataset class is in same package and name is identical to dataset ID.
+        # Assuming dataset class is in same package and module name is identical to dataset ID. Importing the module
+        # registers the dataset class.
         module_name = f'{__name__.split(".")[0]}.{dataset_name}'
-        classes = [
-            m
-            for m in inspect.getmembers(
-                importlib.import_module(module_name), inspect.isclass
-            )
-            if m[1].__module__ == module_name and issubclass(m[1], Dataset)
-        ]
+        importlib.import_module(module_name)
         assert (
-            len(classes) == 1
-        ), f"Module {module_name} should contain exactly one Dataset class definition."
+            dataset_name in cls._registry
+        ), f"Module {module_name} should register a Dataset class for '{dataset_name}'."
 
-        return classes[0][1](**kwargs)
+        return cls._registry[dataset_name](**kwargs)
 
     def clean_assets(self) -> None:
         """Cleans assets, i.e. removes/changes errors in the external datasets that cannot easily be cleaned
@@ -5,10 +5,9 @@ Adapted from https://github.com/explosion/projects/blob/master/nel-wikipedia/ent
 import logging
 import random
 from collections import defaultdict
-from typing import Dict, List, Set, Tuple
+from typing import Callable, Dict, List, Set, Tuple
 
 import prettytable
-from spacy import Language
 from spacy.kb import KnowledgeBase
 from spacy.tokens import Doc
 from utils import get_logger
@@ -175,7 +174,7 @@ def add_disambiguation_eval_result(
     results: EvaluationResults,
     pred_doc: Doc,
     correct_ents: Dict[str, str],
-    el_nlp: Language,
+    el_nlp: Callable[[Doc], Doc],
 ) -> None:
     """
     Evaluate the ent.kb_id_ annotations against the gold standard.
@@ -183,7 +182,7 @@ def add_disambiguation_eval_result(
     results (EvaluationResults): Container for evaluation results.
     pred_doc (Doc): Predicted Doc object to evaluate.
     correct_ents (Dict[str, str]): Dictionary with offsets to entity QIDs.
-    el_nlp (Language): Pipeline.
+    el_nlp (Callable[[Doc], Doc]): Pipeline or entity linker component to apply to pred_doc.
     """
     try:
         for ent in el_nlp(pred_doc).ents:
@@ -13,6 +13,7 @@ from utils import get_logger
 logger = get_logger(__name__)
 
 
+@Dataset.register("reddit")
 class RedditDataset(Dataset):
     """RedditEL dataset."""
 
@@ -106,8 +107,8 @@ class RedditDataset(Dataset):
                         rows.append(row)
 
         # Create spans from annotations.
-        for row in rows:
-            doc = self._nlp_base(row[-1])
+        texts = [row[-1] for row in rows]
+        for row, doc in zip(rows, self._nlp_pipe(texts)):
             # There might be multiple annotations for the same tokens/spans. This is handled by (1) sorting all
             # entities for this document by their frequency and (2) afterwards moving all overlapping entities to
             # the doc's _ attribute, so we might still consider that during evaluation.
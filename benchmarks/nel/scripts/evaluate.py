@@ -5,11 +5,16 @@ import typer
 from custom_functions import create_candidates_via_embeddings
 
 
-def main(dataset_name: str):
+def main(
+    dataset_name: str,
+    n_process: int = typer.Option(
+        1, help="Number of processes to use for processing the test set."
+    ),
+):
     """Evaluate the trained EL component by applying it to unseen text."""
 
     Dataset.generate_dataset_from_id(dataset_name).evaluate(
-        candidate_generation=True, baseline=True, context=True
+        candidate_generation=True, baseline=True, context=True, n_process=n_process
     )
 
 